@@ -1,96 +1,398 @@
 # KenKen puzzle solver
 # reference from: https://github.com/chanioxaris/kenken-solver
-import sys, re, time, random, csp, operator
+import sys, time, random, csp, itertools, math
+import numpy as np
+from utils import argmin_random_tie, count
+
+try:  # numba is optional; without it (or on small boards) constraints() stays on the pure python path
+	from numba import njit
+	HAVE_NUMBA = True
+except ImportError:
+	HAVE_NUMBA = False
+	def njit(*args, **kwargs):
+		return lambda fn: fn
+
+# Domains are kept as int bitmasks: bit v is set iff value v is still possible.
+
+# yield the values of a domain bitmask in increasing order
+def domain_iter(mask):
+	while mask:
+		yield (mask & -mask).bit_length() - 1
+		mask &= mask - 1
+
+# number of values left in a domain bitmask
+def domain_size(mask):
+	return mask.bit_count()
+
+# cages up to this size get their legal value tuples enumerated at load time
+MAX_TUPLE_CAGE = 5
+
+# boards from this size up run constraints() on the numba kernels; on smaller ones
+# the call overhead of the kernels costs more than the pure python checks they replace
+NUMBA_MIN_N = 7
+
+# cage operator codes (Cage.op_code and the numba kernels): OPS[code] is the operator
+OPS = '+-*/='
+OP_ADD, OP_SUB, OP_MUL, OP_DIV, OP_EQ = range(len(OPS))
+
+
+# Numba versions of Kenken.constraints and its cage checks. Per-variable and
+# per-cage data is passed in as flat arrays (see Kenken.build_arrays):
+# the variables of cage c are cage_vars_flat[cage_vars_off[c]:cage_vars_off[c+1]],
+# its legal tuples lie end to end in cage_tup_flat[cage_tup_off[c]:cage_tup_off[c+1]],
+# and assignment_arr[var] is the inferred value of var, or 0.
+
+# same as Kenken.check_add_or_mul_cage, for cage c (B = -1 when there is no B)
+@njit(cache = True)
+def add_or_mul_nb(c, A, a, B, b, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+				  cage_tupled, cage_tup_flat, cage_tup_off, assignment_arr):
+	lo = cage_vars_off[c]
+	k  = cage_vars_off[c+1] - lo
+
+	if cage_tupled[c]:
+		for t in range(cage_tup_off[c], cage_tup_off[c+1], k):
+			match = True
+			for p in range(k):
+				V = cage_vars_flat[lo+p]
+				v = (a if V == A else (b if V == B else assignment_arr[V]))
+				if v != 0 and cage_tup_flat[t+p] != v:
+					match = False
+					break
+			if match:
+				return True
+		return False
+
+	mul       = (cage_op[c] == OP_MUL)
+	current   = (1 if mul else 0)
+	allocated = 0
+	for p in range(k):
+		V = cage_vars_flat[lo+p]
+		v = (a if V == A else (b if V == B else assignment_arr[V]))
+		if v != 0:
+			current = (current * v if mul else current + v)
+			allocated += 1
+
+	if allocated < k:
+		return current <= cage_goal[c]
+	return current == cage_goal[c]
+
+# same as Kenken.check_sub_cage / check_div_cage, for cage c
+@njit(cache = True)
+def sub_or_div_nb(c, X, x, domains, cage_op, cage_goal, cage_vars_flat, cage_vars_off, assignment_arr):
+	lo = cage_vars_off[c]
+	Y  = (cage_vars_flat[lo+1] if cage_vars_flat[lo] == X else cage_vars_flat[lo])
+	g  = cage_goal[c]
+
+	if cage_op[c] == OP_SUB:
+		y1, y2 = x + g, x - g
+	else:
+		y1, y2 = x * g, (x // g if x % g == 0 else 0)
+
+	y = assignment_arr[Y]
+	if y != 0:
+		return y == y1 or y == y2
+
+	# domains only use bits 1..63, so anything else is not a possible value
+	mask = domains[Y]
+	if 0 < y1 < 64 and (mask >> np.uint64(y1)) & np.uint64(1):
+		return True
+	return 0 < y2 < 64 and (mask >> np.uint64(y2)) & np.uint64(1) != 0
+
+# same as Kenken.check_cage_constraint
+@njit(cache = True)
+def cage_constraint_nb(X, x, domains, var_to_cage, var_pos, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+					   cage_pos_mask, cage_tupled, cage_tup_flat, cage_tup_off, assignment_arr):
+	c = var_to_cage[X]
+	if not (cage_pos_mask[cage_vars_off[c] + var_pos[X]] >> np.uint64(x)) & np.uint64(1):
+		return False
+
+	op = cage_op[c]
+	if op == OP_ADD or op == OP_MUL:
+		return add_or_mul_nb(c, X, x, -1, 0, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+							 cage_tupled, cage_tup_flat, cage_tup_off, assignment_arr)
+	elif op == OP_SUB or op == OP_DIV:
+		return sub_or_div_nb(c, X, x, domains, cage_op, cage_goal, cage_vars_flat, cage_vars_off, assignment_arr)
+	return x == cage_goal[c]
+
+# true if A and B are in the same row or column, for boards without neighbor_mask
+@njit(cache = True)
+def is_neighbor_nb(A, B, neighbors_arr):
+	for u in neighbors_arr[A]:
+		if u == B:
+			return True
+	return False
+
+# same as Kenken.constraints
+@njit(cache = True)
+def constraints_nb(A, a, B, b, domains, var_to_cage, var_pos, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+				   cage_pos_mask, cage_tupled, cage_tup_flat, cage_tup_off, neighbor_mask, neighbors_arr, assignment_arr):
+	if neighbor_mask.shape[0]:
+		# (a == b) is 0 or 1, so and-ing it with the shifted mask both picks bit B
+		# and applies the equality test: no data dependent branch
+		if (neighbor_mask[A] >> np.uint64(B)) & np.uint64(a == b):
+			return False
+	elif a == b and is_neighbor_nb(A, B, neighbors_arr):
+		return False
+
+	c = var_to_cage[A]
+	if c == var_to_cage[B]:
+		op = cage_op[c]
+		if op == OP_SUB:
+			return abs(a - b) == cage_goal[c]
+		elif op == OP_DIV:
+			return max(a, b) == min(a, b) * cage_goal[c]
+		return add_or_mul_nb(c, A, a, B, b, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+							 cage_tupled, cage_tup_flat, cage_tup_off, assignment_arr)
+
+	return (cage_constraint_nb(A, a, domains, var_to_cage, var_pos, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+							   cage_pos_mask, cage_tupled, cage_tup_flat, cage_tup_off, assignment_arr) and
+			cage_constraint_nb(B, b, domains, var_to_cage, var_pos, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+							   cage_pos_mask, cage_tupled, cage_tup_flat, cage_tup_off, assignment_arr))
+
+# min-conflicts: how far cage c is from a legal one on board. For a cage with
+# tuples it is the fewest cells that must change to reach one of them, for a
+# larger '+' cage how far its total misses the goal, and 0 or 1 otherwise.
+@njit(cache = True)
+def cage_cost_nb(c, board, cage_op, cage_goal, cage_vars_flat, cage_vars_off, cage_tupled, cage_tup_flat, cage_tup_off):
+	lo = cage_vars_off[c]
+	k  = cage_vars_off[c+1] - lo
+	op = cage_op[c]
+	g  = cage_goal[c]
+
+	if cage_tupled[c]:
+		best = k
+		for t in range(cage_tup_off[c], cage_tup_off[c+1], k):
+			d = 0
+			for p in range(k):
+				if cage_tup_flat[t+p] != board[cage_vars_flat[lo+p]]:
+					d += 1
+			best = min(best, d)
+		return best
+
+	if op == OP_EQ:
+		return (0 if board[cage_vars_flat[lo]] == g else 1)
+	if op == OP_SUB or op == OP_DIV:
+		a, b = board[cage_vars_flat[lo]], board[cage_vars_flat[lo+1]]
+		if op == OP_SUB:
+			return (0 if abs(a - b) == g else 1)
+		return (0 if max(a, b) == min(a, b) * g else 1)
+
+	mul     = (op == OP_MUL)
+	current = (1 if mul else 0)
+	for p in range(k):
+		v = board[cage_vars_flat[lo+p]]
+		current = (current * v if mul else current + v)
+	if mul:
+		return (0 if current == g else 1)
+	return abs(current - g)
+
+# min-conflicts: the number of same valued pairs in column c of board
+# (col_idx[c] are the variables of column c)
+@njit(cache = True)
+def column_cost_nb(c, board, col_idx):
+	N = col_idx.shape[0]
+	n = 0
+	for i in range(N):
+		for j in range(i+1, N):
+			if board[col_idx[c, i]] == board[col_idx[c, j]]:
+				n += 1
+	return n
+
+# min-conflicts: the conflicts of the columns and cages of X and Y on board,
+# with cage conflicts weighted by w
+@njit(cache = True)
+def pair_cost_nb(X, Y, board, col_idx, var_to_cage, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+				 cage_tupled, cage_tup_flat, cage_tup_off, w):
+	N  = col_idx.shape[0]
+	cX = var_to_cage[X]
+	cY = var_to_cage[Y]
+	n  = column_cost_nb(X % N, board, col_idx)
+	n += w * cage_cost_nb(cX, board, cage_op, cage_goal, cage_vars_flat, cage_vars_off, cage_tupled, cage_tup_flat,
+						  cage_tup_off)
+	if Y % N != X % N:
+		n += column_cost_nb(Y % N, board, col_idx)
+	if cY != cX:
+		n += w * cage_cost_nb(cY, board, cage_op, cage_goal, cage_vars_flat, cage_vars_off, cage_tupled, cage_tup_flat,
+							  cage_tup_off)
+	return n
+
+# min-conflicts: deltas[k] is the change in conflicts when X swaps values with
+# the cell in column k of its row (row_idx[r] are the variables of row r)
+@njit(cache = True)
+def swap_deltas_nb(X, board, row_idx, col_idx, var_to_cage, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+				   cage_tupled, cage_tup_flat, cage_tup_off, w):
+	N = row_idx.shape[0]
+	deltas = np.zeros(N, dtype = np.int64)
+	for k in range(N):
+		Y = row_idx[X // N, k]
+		if Y == X:
+			continue
+		before = pair_cost_nb(X, Y, board, col_idx, var_to_cage, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+							  cage_tupled, cage_tup_flat, cage_tup_off, w)
+		board[X], board[Y] = board[Y], board[X]
+		after  = pair_cost_nb(X, Y, board, col_idx, var_to_cage, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+							  cage_tupled, cage_tup_flat, cage_tup_off, w)
+		board[X], board[Y] = board[Y], board[X]
+		deltas[k] = after - before
+	return deltas
+
+# conflicted[X] is true if X shares its value with its column or its cage is broken
+@njit(cache = True)
+def conflicted_nb(board, row_idx, col_idx, var_to_cage, cage_op, cage_goal, cage_vars_flat, cage_vars_off,
+				  cage_tupled, cage_tup_flat, cage_tup_off, w):
+	N = row_idx.shape[0]
+	broken = np.zeros(cage_op.shape[0], dtype = np.bool_)
+	for c in range(cage_op.shape[0]):
+		broken[c] = cage_cost_nb(c, board, cage_op, cage_goal, cage_vars_flat, cage_vars_off, cage_tupled,
+								 cage_tup_flat, cage_tup_off) > 0
+
+	conflicted = np.zeros(board.shape[0], dtype = np.bool_)
+	for X in range(board.shape[0]):
+		conflicted[X] = broken[var_to_cage[X]]
+		for u in col_idx[X % N]:
+			if u != X and board[u] == board[X]:
+				conflicted[X] = True
+	return conflicted
+
 
 class Cage():
 	"""
 	Denote a Cage in the puzzle.
+	The numba kernels see the same data through the Kenken.build_arrays mirrors.
 	"""
+	__slots__ = ('goal', 'opr', 'op_code', 'id', 'vars', 'current', 'allocated', 'tuples', 'pos_mask', 'tightness')
+
 	def __init__(self, name):
-		self.goal = -1
-		self.opr  = ''
-		self.id   = name
-		self.vars = list()
+		self.goal    = -1
+		self.opr     = ''
+		self.op_code = -1       # OPS.index(opr)
+		self.id      = name
+		self.vars    = list()
+
+		# running total of the values currently inferred for this cage's
+		# variables (sum for '+', product for '*') and how many there are
+		self.current   = 0
+		self.allocated = 0
+
+		# tuples   - every legal tuple of values for vars (None for cages bigger than MAX_TUPLE_CAGE)
+		# pos_mask - pos_mask[k] = bitmask of the values vars[k] takes in any of the tuples
+		self.tuples   = None
+		self.pos_mask = None
+
+		# number of value tuples the cage allows (N^len(vars) when they are not enumerated)
+		self.tightness = 0
 
 	def __repr__(self):
 		return "<id: " + self.id + ", goal: " + str(self.goal) + self.opr + ", vars: " + str(self.vars) + ">"
 
-	def __eq__(self, other):
-		if isinstance(other, Cage) and self.id == other.id:
-			return True
-		return False
-
 
 class Kenken():
 	"""
 	Class to denote a Kenken puzzle and methods to solve it
 	"""
 	def __init__(self, filename):
-		# parse data file and populate all data structures
+		# read the whole data file at once, then parse it and populate all data structures
 		with open(filename, 'r') as file:
-			# N          - kenken board size
-			# variables  - [0, 1, ..., N*N-1] one for each board location
-			# domains    - {var: [val0, val1, .., valk]} map of all possible values for each variable
-			# neighbors  - {var: [var0, var1, .., vark]} map of all same row or col variables for each variable
-			#
-			# cage_board - cage_board[i][j] = cage id for (i, j)
-			# cage_dict  - {cage_id: Cage} map of Cage objects for all cages. 
-			self.N          = int(file.readline().strip())
-			self.variables  = list(i for i in range(self.N*self.N))
-			self.domains    = dict((v, list(i for i in range(1, self.N+1)) )for v in self.variables)
-			self.neighbors  = dict()
-
-			self.cage_board = list(list(0 for i in range(self.N)) for j in range(self.N))
-			self.cage_dict  = dict()
-
-			for i in range(self.N):
-				# now read next N lines to find which
-				# cell belongs to which cage (see input data file)
-				line = file.readline().strip()
-				for j in range(len(line)):
-					cage_id = line[j]          # making it case insensitive: may help for larger puzzles
-					self.cage_board[i][j] = cage_id
-
-					if not cage_id in self.cage_dict:
-						self.cage_dict[cage_id] = Cage(cage_id)
-					self.cage_dict[cage_id].vars.append(self.xy_to_variable(i, j))
-
-			# next, read goals for each cage
-			for i in range(len(self.cage_dict)):
-				line    = file.readline().strip()        # e.g 'A:240*'
-				toks    = line.split(":")                #     ['A', '240*']
-				cage_id = toks[0].strip()
-
-				opr     = re.sub('[0-9]', '', toks[1])   # replace digits in 240* with ''
-				goal    = int(toks[1].replace(opr, ''))
-
-				self.cage_dict[cage_id].opr  = opr
-				self.cage_dict[cage_id].goal = goal
-
-				if opr == '-' or opr == '/':
-					# ensure subtract or divide cage have only 2 locations
-					assert len(self.cage_dict[cage_id].vars) == 2
-				elif opr == '=':
-					# ensure identity cage has only 1 location
-					assert len(self.cage_dict[cage_id].vars) == 1
-
-			# populate the dict of {var:[var, var...]} that lists for each variable,
-			# the variables that it has a constraint on.
-			# Each location in kenken puzzle is constrained on all other locations
-			# in the same row and in the same column.
-			# We are not adding same-cage members since that will be checked by constraints function
-			for v in self.variables:
-				self.neighbors[v] = list()
-				(row, col) = self.variable_to_xy(v)
-
-				for _ in range(self.N):
-					if _ != row:
-						# add all same column locations
-						self.neighbors[v].append(self.xy_to_variable(_, col))
-
-					if _ != col:
-						# add all same row locations
-						self.neighbors[v].append(self.xy_to_variable(row, _))
+			lines = file.read().splitlines()
+
+		# N          - kenken board size
+		# variables  - [0, 1, ..., N*N-1] one for each board location
+		# domains    - {var: mask} map of all possible values for each variable, bit v set iff v is possible
+		# neighbors  - {var: [var0, var1, .., vark]} map of all same row or col variables for each variable
+		#              (a view of neighbors_arr, the N*N x 2(N-1) int32 array of the same)
+		#
+		# cage_board - cage_board[i][j] = cage id for (i, j)
+		# cage_dict  - {cage_id: Cage} map of Cage objects for all cages. 
+		self.N          = int(lines[0].strip())
+		self.variables  = list(i for i in range(self.N*self.N))
+		self.domains    = dict((v, ((1 << (self.N+1)) - 1) & ~1) for v in self.variables)
+
+		self.cage_board = list(list(0 for i in range(self.N)) for j in range(self.N))
+		self.cage_dict  = dict()
+
+		# now the next N lines tell which
+		# cell belongs to which cage (see input data file)
+		for (i, line) in enumerate(lines[1:1+self.N]):
+			line = line.strip()
+			for j in range(len(line)):
+				cage_id = line[j]          # making it case insensitive: may help for larger puzzles
+				self.cage_board[i][j] = cage_id
+
+				if not cage_id in self.cage_dict:
+					self.cage_dict[cage_id] = Cage(cage_id)
+				self.cage_dict[cage_id].vars.append(i*self.N + j)     # xy_to_variable(i, j), inlined
+
+		# next, read goals for each cage
+		goal_lines = lines[1+self.N:1+self.N+len(self.cage_dict)]
+		# ensure the file has a goal line for every cage
+		assert len(goal_lines) == len(self.cage_dict)
+		for line in goal_lines:
+			(cage_id, _, tok) = line.partition(":")  # e.g 'A:240*' -> 'A', ':', '240*'
+			cage_id = cage_id.strip()
+
+			tok     = tok.strip()                    #     '240*'
+			if tok[-1] in OPS:
+				opr  = tok[-1]                       #     '*'
+				goal = int(tok[:-1])                 #     240
+			else:
+				opr  = '='
+				goal = int(tok)
+
+			self.cage_dict[cage_id].opr     = opr
+			self.cage_dict[cage_id].op_code = OPS.index(opr)
+			self.cage_dict[cage_id].goal    = goal
+			self.cage_dict[cage_id].current = (1 if opr == '*' else 0)
+
+			if opr == '-' or opr == '/':
+				# ensure subtract or divide cage have only 2 locations
+				assert len(self.cage_dict[cage_id].vars) == 2
+			elif opr == '=':
+				# ensure identity cage has only 1 location
+				assert len(self.cage_dict[cage_id].vars) == 1
+
+		# populate neighbors_arr, whose row v lists the variables that v has a constraint on.
+		# Each location in kenken puzzle is constrained on all other locations
+		# in the same row and in the same column.
+		# We are not adding same-cage members since that will be checked by constraints function
+		# The first N-1 entries are the same column locations, the last N-1 the same row ones.
+		# For k = 0..N-2, other_rows[v][k] = k + (k >= row of v) runs over the N-1 rows other
+		# than v's own, skipping it; other_cols[v][k] does the same for v's column.
+		N    = self.N
+		k    = np.arange(N - 1)
+		rows = np.arange(N * N) // N
+		cols = np.arange(N * N) % N
+		other_rows = k + (k >= rows[:, None])
+		other_cols = k + (k >= cols[:, None])
+
+		self.neighbors_arr = np.empty((N * N, 2 * (N - 1)), dtype = np.int32)
+		self.neighbors_arr[:, :N-1] = other_rows * N + cols[:, None]
+		self.neighbors_arr[:, N-1:] = rows[:, None] * N + other_cols
+
+		# csp.py wants the {var:[var, var...]} form
+		self.neighbors = dict((v, self.neighbors_arr[v].tolist()) for v in self.variables)
+
+		# lookup tables for constraints():
+		# cage_of       - cage_of[var] = Cage that var belongs to
+		# neighbor_mask - bit u of neighbor_mask[var] set iff u is in neighbors[var]
+		self.cage_of       = list(self.cage_dict[self.cage_board[v // self.N][v % self.N]] for v in self.variables)
+		self.neighbor_mask = list(sum(1 << u for u in self.neighbors[v]) for v in self.variables)
+		# cage_pos      - cage_pos[var] = index of var in cage_of[var].vars
+		self.cage_pos      = list(self.cage_of[v].vars.index(v) for v in self.variables)
+
+		for cage in self.cage_dict.values():
+			self.generate_tuples(cage)
+			cage.tightness = (len(cage.tuples) if cage.tuples is not None else self.N ** len(cage.vars))
+
+		# cage_rank - cage_rank[var] = position of cage_of[var] when the cages are
+		#             sorted from the most to the least constrained
+		cage_order      = sorted(self.cage_dict.values(), key = lambda cage: cage.tightness)
+		rank            = dict((cage, r) for (r, cage) in enumerate(cage_order))
+		self.cage_rank  = list(rank[self.cage_of[v]] for v in self.variables)
+
+		self.build_arrays()
+
+		# {var: val} of the currently inferred values, shared live with KenkenCSP.inferred
+		self._assign = dict()
 
 
 	# return the (i, j) corresponding to a variable.
@@ -105,111 +407,209 @@ class Kenken():
 	def xy_to_variable(self, i, j):
 		return i*self.N + j
 
-	# which cage does this variable X belong to?
-	def get_cage(self, X):
-		(i, j)  = self.variable_to_xy(X)
-		cage_id = self.cage_board[i][j]
-		return self.cage_dict[cage_id]
+	# enumerate all value tuples for the cage variables that reach the cage goal
+	# and have no repeated value within a row or column
+	def generate_tuples(self, cage):
+		k = len(cage.vars)
+		if k > MAX_TUPLE_CAGE:
+			return
+
+		# pairs of cage positions that share a row or column
+		clashes = list((p, q) for p in range(k) for q in range(p+1, k)
+					   if (self.neighbor_mask[cage.vars[p]] >> cage.vars[q]) & 1)
+
+		cage.tuples   = list()
+		cage.pos_mask = [0] * k
+		for t in itertools.product(range(1, self.N+1), repeat = k):
+			if any(t[p] == t[q] for (p, q) in clashes):
+				continue
+
+			if cage.op_code == OP_ADD:
+				ok = sum(t) == cage.goal
+			elif cage.op_code == OP_SUB:
+				ok = abs(t[0] - t[1]) == cage.goal
+			elif cage.op_code == OP_MUL:
+				ok = math.prod(t) == cage.goal
+			elif cage.op_code == OP_DIV:
+				ok = max(t) == min(t) * cage.goal
+			else:
+				ok = t[0] == cage.goal
+
+			if ok:
+				cage.tuples.append(t)
+				for p in range(k):
+					cage.pos_mask[p] |= 1 << t[p]
+
+	# mirror the puzzle into flat NumPy arrays for constraints_nb.
+	# neighbor_mask is packed into a uint64 per variable for boards of up to
+	# 64 cells; bigger boards leave it empty and scan neighbors_arr instead.
+	def build_arrays(self):
+		cages = list(self.cage_dict.values())
+		index = dict((cage, c) for (c, cage) in enumerate(cages))
+
+		self.var_to_cage    = np.array(list(index[self.cage_of[v]] for v in self.variables), dtype = np.int32)
+		self.var_pos        = np.array(self.cage_pos, dtype = np.int32)
+		self.cage_op        = np.array(list(cage.op_code for cage in cages), dtype = np.int8)
+		self.cage_goal      = np.array(list(cage.goal for cage in cages), dtype = np.int32)
+		self.cage_vars_flat = np.array(list(v for cage in cages for v in cage.vars), dtype = np.int32)
+		self.cage_vars_off  = np.cumsum([0] + list(len(cage.vars) for cage in cages), dtype = np.int32)
+
+		# cages without tuples accept any value at any position
+		all_values          = ((1 << (self.N+1)) - 1) & ~1
+		self.cage_pos_mask  = np.array(list(m for cage in cages for m in (cage.pos_mask or [all_values] * len(cage.vars))),
+									   dtype = np.uint64)
+		self.cage_tupled    = np.array(list(cage.tuples is not None for cage in cages), dtype = np.bool_)
+		self.cage_tup_flat  = np.array(list(x for cage in cages for t in (cage.tuples or []) for x in t), dtype = np.int8)
+		self.cage_tup_off   = np.cumsum([0] + list(len(cage.tuples or []) * len(cage.vars) for cage in cages), dtype = np.int32)
+
+		self.use_numba      = HAVE_NUMBA and self.N >= NUMBA_MIN_N
+		if len(self.variables) <= 64:
+			self.neighbor_mask_arr = np.array(self.neighbor_mask, dtype = np.uint64)
+		else:
+			self.neighbor_mask_arr = np.zeros(0, dtype = np.uint64)
+
+		# current domains and inferred values, kept in step by KenkenCSP
+		self.domains_arr    = np.array(list(self.domains[v] for v in self.variables), dtype = np.uint64)
+		self.assignment_arr = np.zeros(len(self.variables), dtype = np.int8)
 
 	# return true if A=a and B=b don't violate any constraint,
 	# false otherwise
 	def constraints(self, A, a, B, b):
 		assert A != B
 
-		# if either variable A or B is in the same row/col as the other,
-		# a must not be same as b
-		if B in self.neighbors[A] and a == b:
-			return False 
-		if A in self.neighbors[B] and a == b:
+		if self.use_numba:
+			return constraints_nb(A, a, B, b, self.domains_arr, self.var_to_cage, self.var_pos,
+								  self.cage_op, self.cage_goal, self.cage_vars_flat, self.cage_vars_off,
+								  self.cage_pos_mask, self.cage_tupled, self.cage_tup_flat, self.cage_tup_off,
+								  self.neighbor_mask_arr, self.neighbors_arr, self.assignment_arr)
+
+		# if variable A and B are in the same row/col, a must not be same as b.
+		# The neighbor relation is symmetric, so one test covers both ways, and
+		# (a == b) is 0 or 1, so and-ing it picks bit B and tests a == b in one go
+		if (self.neighbor_mask[A] >> B) & (a == b):
 			return False
 
-		cage_A = self.get_cage(A)
-		cage_B = self.get_cage(B)
-		inferences = kenken_csp.infer_assignment()   # current assignments
+		cage_of = self.cage_of
+		cage_A  = cage_of[A]
 
-		if cage_A == cage_B:
+		if cage_A is cage_of[B]:
 			# both belong to the same cage - need to check cage constraints for each operator
-			if cage_A.opr == '+':
-				return self.check_add_or_mul_cage(inferences, operator.add, A, a, B, b)
-			elif cage_A.opr == '-':
+			oc = cage_A.op_code
+			if oc == OP_ADD or oc == OP_MUL:
+				return self.check_add_or_mul_cage(A, a, B, b)
+			elif oc == OP_SUB:
 				return abs(a - b) == cage_A.goal
-			elif cage_A.opr == '*':
-				return self.check_add_or_mul_cage(inferences, operator.mul, A, a, B, b)
-			elif cage_A.opr == '/':
+			elif oc == OP_DIV:
 				return max(a, b) == min(a, b) * cage_A.goal
-			elif cage_A.opr == '=':
-				# this should never happen: '=' always has a single cage
-				assert False
-			else:
-				print("unknown cage operator: %s" % cage_A.opr)
-				assert False
+			# this should never happen: '=' always has a single cage
+			assert False
 		else:
-			return self.check_cage_constraint(inferences, A, a) and self.check_cage_constraint(inferences, B, b)
+			return self.check_cage_constraint(A, a) and self.check_cage_constraint(B, b)
 
 	# check validity of an add or mul cage, with A=a and B=b (optional)
-	def check_add_or_mul_cage(self, inferences, fn, A, a, B = None, b = None):
-		allocated = 0
-		cage = self.get_cage(A)
-		total = (1 if fn == operator.mul else 0)
-
-		for V in cage.vars:
-			''' #if A (or B) is inferred, its value is a (or b)
-			if V == A and V in inferences:
-				assert a == inferences[V]
-			if V == B and V in inferences:
-				assert b == inferences[V]
-			'''
+	def check_add_or_mul_cage(self, A, a, B = None, b = None):
+		inferences = self._assign
+		cage       = self.cage_of[A]
+
+		if cage.tuples is not None:
+			# some legal tuple must agree with A=a, B=b and the inferred values
+			inferences_get = inferences.get
+			fixed          = list()
+			for (k, V) in enumerate(cage.vars):
+				v = (a if V == A else (b if V == B else inferences_get(V)))
+				if v is not None:
+					fixed.append((k, v))
+			return any(all(t[k] == v for (k, v) in fixed) for t in cage.tuples)
+
+		# too big to enumerate: fall back on the cage running total
+		mul        = (cage.op_code == OP_MUL)
+		current    = cage.current
+		allocated  = cage.allocated
+
+		# tentatively apply A=a (and B=b) to a copy of the cage running total,
+		# taking out the value already inferred for them, if any
+		for (V, v) in ((A, a), (B, b)):
+			if V is None:
+				continue
 			if V in inferences:
-				total = fn(total, inferences[V])
+				current = (current // inferences[V] if mul else current - inferences[V])
+			else:
 				allocated += 1
+			current = (current * v if mul else current + v)
 
-		if total < cage.goal and allocated < len(cage.vars):
-			# all variables are not allocated and current total is not reached too
-			# ie, constraints are still ok
-			return True
-		elif total == cage.goal and allocated == len(cage.vars):
-			# all variables are allocated and all variables are allocated
-			return True
-		return False
+		if allocated < len(cage.vars):
+			# all variables are not allocated: current total must not be past the goal
+			return current <= cage.goal
+		# all variables are allocated: current total must be the goal
+		return current == cage.goal
 
-	# check validity of a sub or div cage, when X=x 
-	def check_sub_or_div_cage(self, inferences, fn, X, x):
-		cage = self.get_cage(X)
+	# check validity of a sub cage, when X=x
+	def check_sub_cage(self, X, x):
+		cage = self.cage_of[X]
+		g    = cage.goal
 
-		# note - subtract or div cage only have 2 variables
-		A, B = cage.vars[0], cage.vars[1]
-		Y = (B if X != B else A)   # Y is the variable other than X in the same cage
+		# note - subtract cage only have 2 variables
+		Y = (cage.vars[1] if cage.vars[0] == X else cage.vars[0])   # Y is the other variable
 
-		if Y in inferences:
-			# if Y already has a value y, |x - y| or max(x,y) / min(x,y) must be cage.goal
-			# for sub, this means max(x, y) == min(x, y) + goal
-			# for div, this means max(x, y) == min(x, y) * goal
-			y = inferences[Y]
-			return max(x, y) == fn(min(x, y), cage.goal)
-		else:
-			# if Y is not inferred yet but has a possible value that will satisfy
-			# cage goal, return true
-			for y in kenken_csp.choices(Y):
-				if max(x, y) == fn(min(x, y), cage.goal):
-					return True
-		return False
+		if Y in self._assign:
+			# if Y already has a value y, |x - y| must be cage.goal
+			y = self._assign[Y]
+			return x - y == g or y - x == g
+
+		# if Y is not inferred yet, x + g or x - g must still be a possible value for it
+		mask = int(self.domains_arr[Y])    # Y's current domain, kept in step by KenkenCSP
+		return bool((mask >> (x + g)) & 1 or (x > g and (mask >> (x - g)) & 1))
+
+	# check validity of a div cage, when X=x
+	def check_div_cage(self, X, x):
+		cage = self.cage_of[X]
+		g    = cage.goal
+
+		# note - div cage only have 2 variables
+		Y = (cage.vars[1] if cage.vars[0] == X else cage.vars[0])   # Y is the other variable
+
+		if Y in self._assign:
+			# if Y already has a value y, max(x,y) / min(x,y) must be cage.goal
+			y = self._assign[Y]
+			return x == y * g or y == x * g
+
+		# if Y is not inferred yet, x * g or x / g must still be a possible value for it
+		mask = int(self.domains_arr[Y])    # Y's current domain, kept in step by KenkenCSP
+		return bool((mask >> (x * g)) & 1 or (x % g == 0 and (mask >> (x // g)) & 1))
 
 	# check if X=x keeps the cage it belongs to consistent
-	def check_cage_constraint(self, inferences, X, x):
-		cage = self.get_cage(X)
-		if cage.opr == '+':
-			return self.check_add_or_mul_cage(inferences, operator.add, X, x)
-		elif cage.opr == '-':
-			return self.check_sub_or_div_cage(inferences, operator.add, X, x)
-		elif cage.opr == '*':
-			return self.check_add_or_mul_cage(inferences, operator.mul, X, x)
-		elif cage.opr == '/':
-			return self.check_sub_or_div_cage(inferences, operator.mul, X, x)
-		elif cage.opr == '=':
-			return x == cage.goal
-		else:
-			print("unknown cage operator: %s" % cage.opr)
-			assert False
+	def check_cage_constraint(self, X, x):
+		cage = self.cage_of[X]
+		if cage.pos_mask is not None and not (cage.pos_mask[self.cage_pos[X]] >> x) & 1:
+			# x does not appear at X's position in any legal tuple
+			return False
+
+		oc = cage.op_code
+		if oc == OP_ADD or oc == OP_MUL:
+			return self.check_add_or_mul_cage(X, x)
+		elif oc == OP_SUB:
+			return self.check_sub_cage(X, x)
+		elif oc == OP_DIV:
+			return self.check_div_cage(X, x)
+		return x == cage.goal     # OP_EQ
+
+	# V has been inferred to be v: fold it into its cage running total
+	def on_assign(self, V, v):
+		cage = self.cage_of[V]
+		if cage.op_code == OP_ADD:
+			cage.current += v
+		elif cage.op_code == OP_MUL:
+			cage.current *= v
+		cage.allocated += 1
+
+	# V is no longer inferred to be v: undo on_assign
+	def on_unassign(self, V, v):
+		cage = self.cage_of[V]
+		if cage.op_code == OP_ADD:
+			cage.current -= v
+		elif cage.op_code == OP_MUL:
+			cage.current //= v
+		cage.allocated -= 1
 
 	# display a kenken board   
 	def print_result(self, assignment):
@@ -225,13 +625,161 @@ class Kenken():
 		else:
 			print("no solution found")
 
+
+class KenkenCSP(csp.CSP):
+	"""
+	A CSP whose domains and curr_domains are int bitmasks instead of lists.
+	Removals are recorded as (var, mask) pairs of the values taken out.
+	Whenever a curr_domain narrows down to (or widens from) a single value,
+	the Kenken cage running totals are updated through on_assign/on_unassign.
+	"""
+	def __init__(self, kenken):
+		csp.CSP.__init__(self, kenken.variables, kenken.domains, kenken.neighbors, kenken.constraints)
+		self.kenken   = kenken
+		self.inferred = kenken._assign    # {var: val} for every var whose curr_domain is a single value
+
+	def support_pruning(self):
+		if self.curr_domains is None:
+			self.curr_domains = dict(self.domains)
+			for v in self.variables:
+				self.update_inferred(v)
+
+	# sync inferred (and the cage running totals and the Kenken
+	# domains_arr/assignment_arr mirrors) with curr_domains[var]
+	def update_inferred(self, var):
+		mask = self.curr_domains[var]
+		val  = (mask.bit_length() - 1 if mask and not mask & (mask - 1) else 0)
+		old  = self.inferred.get(var, 0)
+		self.kenken.domains_arr[var] = mask
+		if val == old:
+			return
+		self.kenken.assignment_arr[var] = val
+		if old:
+			del self.inferred[var]
+			self.kenken.on_unassign(var, old)
+		if val:
+			self.inferred[var] = val
+			self.kenken.on_assign(var, val)
+
+	def suppose(self, var, value):
+		self.support_pruning()
+		removals = list()
+		self.prune_mask(var, self.curr_domains[var] & ~(1 << value), removals)
+		return removals
+
+	def prune(self, var, value, removals):
+		self.prune_mask(var, 1 << value, removals)
+
+	# rule out all values in mask for var
+	def prune_mask(self, var, mask, removals):
+		self.curr_domains[var] &= ~mask
+		self.update_inferred(var)
+		if removals is not None:
+			removals.append((var, mask))
+
+	def choices(self, var):
+		return domain_iter((self.curr_domains or self.domains)[var])
+
+	def infer_assignment(self):
+		self.support_pruning()
+		return dict(self.inferred)
+
+	def restore(self, removals):
+		for B, mask in removals:
+			self.curr_domains[B] |= mask
+			self.update_inferred(B)
+
+
+# remaining values of var, for the mrv tie-break (csp.num_legal_values expects list domains)
+def num_legal_values(kcsp, var, assignment):
+	if kcsp.curr_domains:
+		return domain_size(kcsp.curr_domains[var])
+	else:
+		return count(kcsp.nconflicts(var, val, assignment) == 0
+					 for val in domain_iter(kcsp.domains[var]))
+
+# variable ordering: take the tightest cage (fewest legal tuples) that still has
+# unassigned variables, and in it the variable with minimum remaining values
+def tightest_cage_mrv(assignment, kcsp):
+	rank = kcsp.kenken.cage_rank
+	return min((v for v in kcsp.variables if v not in assignment),
+			   key=lambda var: (rank[var], num_legal_values(kcsp, var, assignment)))
+
+# arc consistency AC4 over bitmask domains, as in csp.AC4: support[(Xi, Xj)][x]
+# is the mask of Xj values supporting Xi=x, and its popcount the AC4 support
+# counter, so Xi=x loses its last support on arc (Xi, Xj) when the mask hits 0
+def AC4(kcsp, removals=None):
+	kcsp.support_pruning()
+	domains     = kcsp.curr_domains
+	support     = dict()
+	unsupported = list()     # (var, val) pairs pruned but not yet propagated
+
+	# construction and initialization of support sets
+	for Xi in kcsp.variables:
+		for Xj in kcsp.neighbors[Xi]:
+			arc_support = support[(Xi, Xj)] = dict()
+			for x in domain_iter(domains[Xi]):
+				mask = 0
+				for y in domain_iter(domains[Xj]):
+					if kcsp.constraints(Xi, x, Xj, y):
+						mask |= 1 << y
+				arc_support[x] = mask
+				if not mask:
+					kcsp.prune(Xi, x, removals)
+					unsupported.append((Xi, x))
+			if not domains[Xi]:
+				return False
+
+	# propagation of removed values: Xj=y no longer supports anything
+	# (neighbors are symmetric, so the arcs into Xj come from its neighbors)
+	while unsupported:
+		Xj, y = unsupported.pop()
+		for Xi in kcsp.neighbors[Xj]:
+			arc_support = support[(Xi, Xj)]
+			for x in domain_iter(domains[Xi]):
+				if (arc_support[x] >> y) & 1:
+					arc_support[x] &= ~(1 << y)
+					if not arc_support[x]:
+						kcsp.prune(Xi, x, removals)
+						unsupported.append((Xi, x))
+			if not domains[Xi]:
+				return False
+	return True
+
+# min-conflicts hill climbing, as in csp.min_conflicts_with_num_assignments, on a
+# NumPy board whose rows are kept as permutations of 1..N: a step swaps a random
+# conflicted variable with the cell of its row that leaves the fewest conflicts,
+# so only column repeats and broken cages (weighted by N // 2) are counted.
+def min_conflicts_fast(kenken, max_steps=100000):
+	N       = kenken.N
+	row_idx = np.arange(N * N, dtype = np.int32).reshape(N, N)    # row_idx[r] = variables of row r
+	col_idx = np.ascontiguousarray(row_idx.T)                     # col_idx[c] = variables of column c
+	board   = np.empty(len(kenken.variables), dtype = np.int8)
+	tables  = (board, row_idx, col_idx, kenken.var_to_cage, kenken.cage_op, kenken.cage_goal, kenken.cage_vars_flat,
+			   kenken.cage_vars_off, kenken.cage_tupled, kenken.cage_tup_flat, kenken.cage_tup_off, N // 2)
+
+	# generate a complete assignment, each row a random permutation (probably with conflicts)
+	for r in range(N):
+		board[row_idx[r]] = random.sample(range(1, N+1), N)
+	# now repeatedly choose a random conflicted variable and swap it within its row
+	for i in range(max_steps):
+		conflicted = np.flatnonzero(conflicted_nb(*tables))
+		if not len(conflicted):
+			return dict((v, int(board[v])) for v in kenken.variables), i
+		var    = int(random.choice(conflicted))
+		deltas = swap_deltas_nb(var, *tables)
+		k      = argmin_random_tie((k for k in range(N) if k != var % N), key=lambda k: deltas[k])
+		Y      = int(row_idx[var // N, k])
+		board[var], board[Y] = board[Y], board[var]
+	return None, i
+
 if __name__ == "__main__":
 	if len(sys.argv) < 2:
 		print("Insufficient arguments passed. Sample usage:\npython kenken.py <path-to-input-file>")
 	filename = sys.argv[1]
 
 	kenken     = Kenken(filename)
-	kenken_csp = csp.CSP(kenken.variables, kenken.domains, kenken.neighbors, kenken.constraints)
+	kenken_csp = KenkenCSP(kenken)
 
 	# 1. Basic backtracking
 	print("1. Running basic backtracking ...")
@@ -239,19 +787,19 @@ if __name__ == "__main__":
 	kenken.print_result(assignment1)
 	print("(1) no. of assignments:", node_count)
 
-	# 2. Improved backtacking: arc consistency (AC3) along with
-	# minimum remaining heuristic and forward checking inference
-	print("\n2. Improvement: AC3 along with mrv and forward_checking ...")
+	# 2. Improved backtacking: arc consistency (AC4) along with
+	# tightest cage / minimum remaining heuristic and forward checking inference
+	print("\n2. Improvement: AC4 along with tightest cage mrv and forward_checking ...")
 
-	# arc consistency AC3 algorithm as per text book.
-	csp.AC3(kenken_csp)
-	assignment2, node_count = csp.backtracking_search_with_assigment_count(kenken_csp, select_unassigned_variable=csp.mrv)
+	# arc consistency AC4 algorithm with bitmask support sets.
+	AC4(kenken_csp)
+	assignment2, node_count = csp.backtracking_search_with_assigment_count(kenken_csp, select_unassigned_variable=tightest_cage_mrv)
 	kenken.print_result(assignment2)
 	print("(2) no. of assignments: ", node_count)
 
-	steps = 1000
+	steps = 20000
 	print("\n3. Local search (min min_conflicts - a hill climbing algorithm with %d max steps" % steps)
-	assignment3, iterations = csp.min_conflicts_with_num_assignments(kenken_csp, max_steps = steps)
+	assignment3, iterations = min_conflicts_fast(kenken, max_steps = steps)
 	kenken.print_result(assignment3)
 	print("(3) no. of iterations:", iterations)
 